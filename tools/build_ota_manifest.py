@@ -6,12 +6,12 @@ Creates a MicroPython app-level OTA manifest for your Pico device.
 
 It:
   1) Walks a local app directory (default: ./app)
-  2) Computes SHA-256 for each file
+  2) Computes SHA-256 (or, opt-in, BLAKE3) for each file
   3) (Optionally) copies those files into a repo "release folder" for raw hosting:
         ./releases/<version>/...
   4) Writes/updates ./ota/manifest.json with:
         - version
-        - per-file raw URLs + sha256
+        - per-file raw URLs + sha256 (or blake3 with --hash blake3)
 
 This matches the on-device OTA framework we set up:
   - device pulls https://raw.githubusercontent.com/<USER>/<REPO>/main/ota/manifest.json
@@ -26,13 +26,16 @@ Typical repo layout:
 from __future__ import annotations
 
 import argparse
+import functools
 import hashlib
 import json
+import mmap
 import os
 import shutil
 import sys
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import Dict, List, Tuple
+from typing import Dict, Iterator, List, Tuple
 
 
 DEFAULT_EXCLUDES = {
@@ -40,41 +43,104 @@ DEFAULT_EXCLUDES = {
     "Thumbs.db",
 }
 
+# Read size for the chunked hashing fallback
+HASH_BLOCK = 1 << 20
 
-def sha256_file(path: Path) -> str:
+# Files up to this size are hashed from a memory map in a single update() call
+MMAP_MAX = 32 * 1024 * 1024
+
+
+def sha256_file(path: Path, size: int | None = None) -> str:
+    # Pass size when it is already known (e.g. from the directory walk) to skip a stat()
+    if size is None:
+        size = path.stat().st_size
+    # mmap() rejects empty files, so those take the regular path
+    if 0 < size <= MMAP_MAX:
+        with path.open("rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            return hashlib.sha256(m).hexdigest()
+
+    if sys.version_info >= (3, 11):
+        # Read/update loop runs entirely in C
+        with path.open("rb") as f:
+            return hashlib.file_digest(f, "sha256").hexdigest()
+
+    # One buffer per call (calls run on several threads), reused for every block
     h = hashlib.sha256()
-    with path.open("rb") as f:
-        for chunk in iter(lambda: f.read(64 * 1024), b""):
-            h.update(chunk)
+    buf = bytearray(HASH_BLOCK)
+    mv = memoryview(buf)
+    with path.open("rb", buffering=0) as f:
+        while n := f.readinto(buf):
+            h.update(mv[:n])
     return h.hexdigest()
 
 
-def is_within(path: Path, root: Path) -> bool:
+def blake3_file(path: Path, size: int | None = None) -> str:
+    # Optional dependency: only needed when --hash blake3 is selected.
+    # size is unused (update_mmap sizes the map itself); kept to match sha256_file.
     try:
-        path.resolve().relative_to(root.resolve())
-        return True
-    except Exception:
-        return False
+        import blake3
+    except ImportError as e:
+        raise RuntimeError("BLAKE3 hashing requires the 'blake3' package (pip install blake3)") from e
+    h = blake3.blake3(max_threads=blake3.blake3.AUTO)
+    h.update_mmap(path)
+    return h.hexdigest()
+
+
+def hash_and_copy(src: Path, dst: Path, block: int = HASH_BLOCK) -> str:
+    # Single read pass: each block feeds both the SHA-256 and the release copy
+    h = hashlib.sha256()
+    buf = bytearray(block)
+    mv = memoryview(buf)
+    with src.open("rb", buffering=0) as fin, dst.open("wb") as fout:
+        while n := fin.readinto(buf):
+            h.update(mv[:n])
+            fout.write(mv[:n])
+    os.chmod(dst, 0o644)
+    return h.hexdigest()
+
+
+HASH_FUNCS = {
+    "sha256": sha256_file,
+    "blake3": blake3_file,
+}
+
+
+@functools.lru_cache(maxsize=None)
+def hash_file_cached(path: str, size: int, mtime_ns: int, hash_name: str = "sha256") -> str:
+    # In-process memo: size/mtime_ns are only part of the key, so a file that
+    # changes between calls misses. path should be resolved by the caller.
+    return HASH_FUNCS[hash_name](Path(path), size)
+
+
+def is_within(path: Path, resolved_root: Path) -> bool:
+    # Callers resolve the root once (root.resolve()) and reuse it across calls
+    return path.resolve().is_relative_to(resolved_root)
 
 
-def collect_files(app_dir: Path, excludes: set[str]) -> List[Path]:
+def _scandir_recursive(root: str, excludes: set[str]) -> Iterator[os.DirEntry]:
+    # os.scandir caches the type info from the directory read, so there is
+    # no extra stat() per entry (unlike Path.rglob + is_dir).
+    with os.scandir(root) as it:
+        for entry in it:
+            # Skip hidden and excluded names (common in repos) before descending
+            if entry.name in excludes or entry.name.startswith("."):
+                continue
+            if entry.is_dir(follow_symlinks=False):
+                yield from _scandir_recursive(entry.path, excludes)
+            elif entry.is_file():
+                yield entry
+
+
+def collect_file_stats(app_dir: Path, excludes: set[str]) -> List[Tuple[Path, os.stat_result]]:
     if not app_dir.exists() or not app_dir.is_dir():
         raise FileNotFoundError(f"App dir not found: {app_dir}")
 
-    files: List[Path] = []
-    for p in app_dir.rglob("*"):
-        if p.is_dir():
-            continue
-        if p.name in excludes:
-            continue
-        # Skip hidden files by default (common in repos)
-        if p.name.startswith("."):
-            continue
-        files.append(p)
+    # Stat during the walk (DirEntry caches it) so later stages don't stat again
+    found = [(e.path, e.stat()) for e in _scandir_recursive(str(app_dir), excludes)]
 
     # Stable ordering for clean diffs
-    files.sort(key=lambda x: str(x).lower())
-    return files
+    found.sort(key=lambda item: item[0].lower())
+    return [(Path(p), st) for p, st in found]
 
 
 def bump_patch(version: str) -> str:
@@ -108,46 +174,178 @@ def ensure_parent(path: Path) -> None:
     path.parent.mkdir(parents=True, exist_ok=True)
 
 
-def write_manifest(manifest_path: Path, manifest: Dict) -> None:
+def load_hash_cache(cache_path: Path) -> Dict[str, Dict]:
+    # resolved abs path -> {"size", "mtime_ns", <hash_name>: digest}
+    if not cache_path.exists():
+        return {}
+    try:
+        data = json.loads(cache_path.read_text(encoding="utf-8"))
+        if isinstance(data, dict):
+            return data
+    except Exception:
+        pass
+    return {}
+
+
+def cached_digests(
+    cache: Dict[str, Dict],
+    keys: List[str],
+    stats: List[os.stat_result],
+    hash_name: str,
+) -> List[str | None]:
+    # Cached digest where (size, mtime_ns) still match, else None
+    digests: List[str | None] = []
+    for key, st in zip(keys, stats):
+        cached = cache.get(key)
+        if (
+            isinstance(cached, dict)
+            and cached.get("size") == st.st_size
+            and cached.get("mtime_ns") == st.st_mtime_ns
+            and hash_name in cached
+        ):
+            digests.append(cached[hash_name])
+        else:
+            digests.append(None)
+    return digests
+
+
+def build_hash_cache(
+    keys: List[str],
+    stats: List[os.stat_result],
+    digests: List[str],
+    hash_name: str,
+) -> Dict[str, Dict]:
+    return {
+        key: {"size": st.st_size, "mtime_ns": st.st_mtime_ns, hash_name: digest}
+        for key, st, digest in zip(keys, stats, digests)
+    }
+
+
+def write_hash_cache(cache_path: Path, cache: Dict[str, Dict]) -> None:
+    # Write to a temp file and swap it in so an interrupted run can't leave a torn cache
+    ensure_parent(cache_path)
+    tmp = cache_path.with_name(cache_path.name + ".tmp")
+    tmp.write_text(json.dumps(cache, sort_keys=True) + "\n", encoding="utf-8")
+    os.replace(tmp, cache_path)
+
+
+def write_manifest(manifest_path: Path, manifest: Dict, compact: bool = False) -> None:
+    # Serialize fully before opening (which truncates) so a failure keeps the old manifest
+    if compact:
+        # Canonical form: sorted keys + no whitespace gives stable bytes to hash
+        data = json.dumps(manifest, separators=(",", ":"), sort_keys=True)
+    else:
+        data = json.dumps(manifest, indent=2, sort_keys=False)
     ensure_parent(manifest_path)
-    manifest_path.write_text(json.dumps(manifest, indent=2, sort_keys=False) + "\n", encoding="utf-8")
+    with manifest_path.open("wb") as f:
+        f.write(data.encode("utf-8"))
+        f.write(b"\n")
 
 
-def copy_release_files(app_dir: Path, files: List[Path], release_dir: Path) -> None:
+def prepare_release_dir(release_dir: Path) -> None:
     # release_dir is the root (e.g. ./releases/0.0.2)
     if release_dir.exists():
         shutil.rmtree(release_dir)
     release_dir.mkdir(parents=True, exist_ok=True)
 
-    for f in files:
-        rel = f.relative_to(app_dir)
-        dest = release_dir / rel
-        dest.parent.mkdir(parents=True, exist_ok=True)
-        shutil.copy2(f, dest)
+
+def copy_release_file(src: Path, dest: Path) -> None:
+    # dest.parent must already exist. Contents only: copyfile stays in-kernel (sendfile) and skips metadata copying
+    shutil.copyfile(src, dest)
+    os.chmod(dest, 0o644)
+
+
+def _hash_and_stage(
+    src: Path,
+    st: os.stat_result,
+    dest: Path | None,
+    digest: str | None,
+    hash_name: str,
+) -> str:
+    # Copy src into the release dir (if dest is given) and return its digest,
+    # reading the file only once when both are needed. dest.parent must exist.
+    if dest is not None:
+        # Always hash what was copied, so the digest matches the released bytes
+        if hash_name == "sha256":
+            return hash_and_copy(src, dest)
+        copy_release_file(src, dest)
+        return HASH_FUNCS[hash_name](dest)
+    if digest is None:
+        digest = hash_file_cached(str(src.resolve()), st.st_size, st.st_mtime_ns, hash_name)
+    return digest
+
+
+def hash_files(
+    files: List[Path],
+    stats: List[os.stat_result],
+    hash_name: str = "sha256",
+    known: List[str | None] | None = None,
+    dests: List[Path] | None = None,
+) -> List[str]:
+    """
+    Return the digest of each file, in the same order as files.
+
+    known holds digests to reuse (None where the file must be hashed).
+
+    If dests is given, each file is also copied to its dest in the same pass
+    that hashes it, and known is ignored: every file is read anyway, and the
+    digest must describe the copied bytes. The destination directories must
+    already exist.
+    """
+    digests: List[str | None] = [None] * len(files)
+    if dests is not None:
+        todo = list(range(len(files)))
+    else:
+        if known is not None:
+            digests = list(known)
+        # Files that are neither stale nor copied need no I/O at all
+        todo = [i for i, d in enumerate(digests) if d is None]
+        dests = [None] * len(files)
+
+    # hashlib releases the GIL while hashing, so files can be processed concurrently.
+    # map() yields results in input order, keeping the manifest deterministic.
+    if todo:
+        workers = min(32, (os.cpu_count() or 1) * 2)
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            results = pool.map(
+                _hash_and_stage,
+                [files[i] for i in todo],
+                [stats[i] for i in todo],
+                [dests[i] for i in todo],
+                [digests[i] for i in todo],
+                [hash_name] * len(todo),
+            )
+            for i, digest in zip(todo, results):
+                digests[i] = digest
+    return digests
 
 
 def build_manifest_entries(
     app_dir: Path,
     files: List[Path],
     url_base: str,
+    digests: List[str],
+    hash_name: str = "sha256",
 ) -> List[Dict]:
     """
     url_base should point to where the files will be hosted, for example:
       https://raw.githubusercontent.com/<USER>/<REPO>/main/releases/0.0.2
 
     We will append "/<relative path>" to that base.
+
+    digests are the per-file digests from hash_files. hash_name ("sha256" or
+    "blake3") is used as the entry key, so the device must verify with the
+    same algorithm.
     """
-    entries: List[Dict] = []
-    for f in files:
-        rel = f.relative_to(app_dir).as_posix()
-        entries.append(
-            {
-                "path": rel,  # relative to /app on-device
-                "url": f"{url_base.rstrip('/')}/{rel}",
-                "sha256": sha256_file(f),
-            }
-        )
-    return entries
+    base = url_base.rstrip("/") + "/"
+    return [
+        {
+            "path": rel,  # relative to /app on-device
+            "url": base + rel,
+            hash_name: digest,
+        }
+        for rel, digest in zip((f.relative_to(app_dir).as_posix() for f in files), digests)
+    ]
 
 
 def main(argv: List[str]) -> int:
@@ -190,8 +388,32 @@ def main(argv: List[str]) -> int:
         default=[],
         help="Additional filename to exclude (can repeat).",
     )
+    parser.add_argument(
+        "--hash",
+        choices=sorted(HASH_FUNCS),
+        default="sha256",
+        help="Per-file digest written to the manifest (default: sha256). blake3 requires the device to support it.",
+    )
+    parser.add_argument(
+        "--compact",
+        action="store_true",
+        help="Write the manifest as compact JSON with sorted keys (smaller, byte-for-byte deterministic).",
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="With --no-copy, re-hash every file instead of reusing digests from <manifest dir>/.hash_cache.json.",
+    )
     args = parser.parse_args(argv)
 
+    # Fail before touching releases/ rather than midway through the copy
+    if args.hash == "blake3":
+        try:
+            import blake3  # noqa: F401
+        except ImportError:
+            print("--hash blake3 requires the 'blake3' package (pip install blake3).", file=sys.stderr)
+            return 2
+
     app_dir = Path(args.app_dir)
     manifest_path = Path(args.manifest_path)
     releases_root = Path(args.releases_root)
@@ -208,27 +430,51 @@ def main(argv: List[str]) -> int:
             version = "0.0.1"
 
     # Collect files
-    files = collect_files(app_dir, excludes=excludes)
+    found = collect_file_stats(app_dir, excludes=excludes)
+    files = [p for p, _ in found]
     if not files:
         print(f"No files found under {app_dir}. Nothing to do.", file=sys.stderr)
         return 2
 
-    # Copy files into releases/<version>/...
     release_dir = releases_root / version
+    stats = [st for _, st in found]
+
+    # Reuse digests of files unchanged since the last run. Only used with
+    # --no-copy: copying reads every file anyway, and its digest must match
+    # the copied bytes. Keyed by resolved path so another --app-dir can't match.
+    keys = [str(f.resolve()) for f in files]
+    cache_path = None if args.no_cache else manifest_path.parent / ".hash_cache.json"
+    known = None
+    if cache_path and args.no_copy:
+        known = cached_digests(load_hash_cache(cache_path), keys, stats, args.hash)
+
+    # Copy files into releases/<version>/... (done while hashing them)
+    dests = None
     if not args.no_copy:
-        copy_release_files(app_dir, files, release_dir)
+        prepare_release_dir(release_dir)
+        dests = [release_dir / f.relative_to(app_dir) for f in files]
+        # One mkdir per distinct directory, not per file
+        made = set()
+        for dest in dests:
+            if dest.parent not in made:
+                dest.parent.mkdir(parents=True, exist_ok=True)
+                made.add(dest.parent)
+
+    digests = hash_files(files, stats, hash_name=args.hash, known=known, dests=dests)
+    if cache_path:
+        write_hash_cache(cache_path, build_hash_cache(keys, stats, digests, args.hash))
 
     # Construct URL base (points to releases/<version>)
     url_base = f"https://raw.githubusercontent.com/{args.user}/{args.repo}/{args.branch}/{releases_root.as_posix()}/{version}"
 
-    entries = build_manifest_entries(app_dir, files, url_base=url_base)
+    entries = build_manifest_entries(app_dir, files, url_base=url_base, digests=digests, hash_name=args.hash)
 
     manifest = {
         "version": version,
         "files": entries,
     }
 
-    write_manifest(manifest_path, manifest)
+    write_manifest(manifest_path, manifest, compact=args.compact)
 
     # Summary
     print(f"Version: {version}")
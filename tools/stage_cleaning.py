@@ -1,16 +1,25 @@
 #stage_cleaning.py
 
-import ota, os
+import os
 
-# Remove leftover staging artifacts
-try:
-    ota._rm_tree("/staging/app_new")
-except Exception:
-    pass
+# Remove leftover staging artifacts (app_new/, _manifest_tmp.json, ...) in one walk.
+# ilistdir gives the entry type directly, so no extra stat per entry on flash.
+def _bulk_clean(root):
+    try:
+        entries = list(os.ilistdir(root))
+    except OSError:
+        return
+    for name, typ, *_ in entries:
+        p = root + "/" + name
+        try:
+            if typ == 0x4000:
+                _bulk_clean(p)
+                os.rmdir(p)
+            else:
+                os.remove(p)
+        except Exception:
+            pass
 
-try:
-    os.remove("/staging/_manifest_tmp.json")
-except Exception:
-    pass
+_bulk_clean("/staging")
 
 print("Staging cleaned.")
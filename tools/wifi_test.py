@@ -5,12 +5,16 @@ wlan.active(True)
 
 wlan.connect("SteAle2", "edce7b36b6")
 
+# Poll quickly at first, backing off to 0.5 s (typical connect takes 2-4 s)
+delay = 0.1
 for i in range(40):
     st = wlan.status()
-    print(i, "status:", st, "connected:", wlan.isconnected())
-    if wlan.isconnected() or st < 0:
+    connected = wlan.isconnected()
+    print(i, "status:", st, "connected:", connected)
+    if connected or st < 0:
         break
-    time.sleep(0.5)
+    time.sleep(delay)
+    delay = min(delay * 1.5, 0.5)
 
 print("final status:", wlan.status())
 print("ifconfig:", wlan.ifconfig())